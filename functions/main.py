@@ -1,38 +1,281 @@
 from firebase_functions import https_fn, options
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+from cachetools import LRUCache, TTLCache
+from dataclasses import dataclass
+from functools import lru_cache
 import base64
-import json
-import requests
+import hashlib
+import heapq
+import io
 import os
 import re
 import asyncio
+import concurrent.futures
+import atexit
+import threading
 import httpx
+import orjson
+import logging
 import time
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, so jsonify and get_json skip stdlib json"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # orjson already returns bytes; skip the str round trip dumps() needs
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype=self.mimetype)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Securely get API keys from Firebase Secrets
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 USDA_API_KEY = os.environ.get('USDA_API_KEY')
-GEMINI_API_URL = 'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-exp:generateContent'
+GEMINI_ORIGIN = 'https://generativelanguage.googleapis.com'
+GEMINI_API_URL = f'{GEMINI_ORIGIN}/v1beta/models/gemini-2.0-flash-exp:streamGenerateContent'
 USDA_BASE_URL = "https://api.nal.usda.gov/fdc/v1"
 
-# Logging functions
+# Full tracebacks are only worth their formatting cost when debugging
+DEBUG = bool(os.environ.get('DEBUG'))
+
+# Cloud Logging timestamps entries itself; below WARNING nothing is formatted
+# unless DEBUG is set, so the serving path does no log I/O
+logging.basicConfig(format="%(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("food_analyzer")
+logger.setLevel(logging.DEBUG if DEBUG else logging.WARNING)
+
+# One event loop for the whole instance: requests submit their coroutines here
+# instead of spinning up a loop each, so pooled connections survive between calls
+EVENT_LOOP = asyncio.new_event_loop()
+threading.Thread(target=EVENT_LOOP.run_forever, name="food-analyzer-event-loop", daemon=True).start()
+
+# Pillow decoding holds the GIL for much of its work, so a few threads are all
+# the concurrent image shrinking an instance can use
+IMAGE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="image-shrink")
+
+# JSON bodies shrink several-fold compressed; httpx decodes br via the brotli extra
+COMPRESSED_RESPONSES = {"Accept-Encoding": "gzip, br"}
+
+# Pooled Gemini client, kept warm across invocations on the same instance.
+# Over HTTP/2, concurrent analyses share one multiplexed connection
+GEMINI_CLIENT = httpx.AsyncClient(
+    timeout=30.0,
+    limits=httpx.Limits(max_keepalive_connections=10),
+    headers=COMPRESSED_RESPONSES,
+    http2=True
+)
+
+# Pooled USDA client shared by every lookup, so TLS is set up once per instance
+USDA_CLIENT = httpx.AsyncClient(
+    base_url=USDA_BASE_URL,
+    timeout=15,
+    limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+    headers=COMPRESSED_RESPONSES,
+    http2=True
+)
+
+# USDA databases in search priority order
+USDA_DATABASES = [
+    {"name": "Foundation", "dataType": "Foundation", "priority": 1},
+    {"name": "SR Legacy", "dataType": "SR Legacy", "priority": 2},
+    {"name": "Survey (FNDDS)", "dataType": "Survey (FNDDS)", "priority": 3},
+    {"name": "Branded", "dataType": "Branded", "priority": 4}
+]
+
+# Caps in-flight USDA requests per instance so fan-out doesn't trip rate limits.
+# Room for a four-item plate across all four databases in one wave, still
+# under the USDA client's 20 pooled connections
+USDA_SEMAPHORE = asyncio.Semaphore(16)
+
+# (keyword, standard key, excluded keyword) checked in order against each
+# lowercased USDA nutrient name; the first hit wins
+NUTRIENT_KEYWORDS = (
+    ("energy", "calories", None),
+    ("calorie", "calories", None),
+    ("protein", "protein", None),
+    ("carbohydrate", "carbohydrates", None),
+    ("total lipid", "fat", None),
+    ("fat", "fat", "sat"),
+    ("fiber", "fiber", None)
+)
+NUTRIENT_KEYS = frozenset(key for _, key, _ in NUTRIENT_KEYWORDS)
+
+# USDA publishes new data a couple of times a year, so a day-old answer is fresh
+USDA_CACHE_TTL = 24 * 3600
+
+# comprehensive_usda_search results per normalized food name. Callers only read
+# these dicts, and they are only touched from EVENT_LOOP, so no copy or lock
+USDA_SEARCH_CACHE = TTLCache(maxsize=1024, ttl=USDA_CACHE_TTL)
+
+# Processed foods per single-database query. A search that lost one database
+# isn't cached whole, but its retry still reuses the databases that answered
+USDA_DATABASE_CACHE = TTLCache(maxsize=4096, ttl=USDA_CACHE_TTL)
+
+# (ETag, processed foods) per single-database query, kept after the search cache
+# expires so the next lookup can revalidate with If-None-Match
+USDA_ETAG_CACHE = LRUCache(maxsize=2048)
+
+# Most USDA results a search returns alongside its best match
+MAX_SEARCH_RESULTS = 20
+
+# Relevance scoring tables: database priority points, and description words
+# that mark branded or basic foods (substrings, so "ltd" also hits "ltd.")
+DATABASE_RELEVANCE_SCORES = {
+    "Foundation": 100,
+    "SR Legacy": 80,
+    "Survey (FNDDS)": 60,
+    "Branded": 40
+}
+BRAND_WORDS = ("brand", "inc.", "corp", "company", "ltd")
+BASIC_FOOD_WORDS = ("raw", "fresh", "plain")
+
+# Each word table as one alternation, so a description is scanned once per table
+# in C instead of once per word
+BRAND_WORDS_RE = re.compile("|".join(map(re.escape, BRAND_WORDS)))
+BASIC_FOOD_WORDS_RE = re.compile("|".join(map(re.escape, BASIC_FOOD_WORDS)))
+
+# Markdown code fences Gemini wraps around its JSON answer
+JSON_FENCE_RE = re.compile(r'```(?:json)?\s*|\s*```\s*$')
+
+# Base64 alphabet (line breaks allowed) with up to two padding characters at the end
+BASE64_RE = re.compile(r'[A-Za-z0-9+/\r\n]*={0,2}')
+BASE64_CHECK_CHARS = 4096
+
+# Gemini still sees enough detail at this size; bigger uploads are shrunk first
+GEMINI_IMAGE_MAX_SIDE = 1024
+GEMINI_IMAGE_QUALITY = 80
+SMALL_IMAGE_BYTES = 200 * 1024
+
+# Enhanced prompt for better food identification
+GEMINI_PROMPT = """
+Analyze this food image and identify all visible food items with maximum accuracy.
+
+For each food item you identify:
+1. Provide the most specific, common food name possible (avoid brand names)
+2. Use standard food terminology that would be found in nutrition databases
+3. Estimate the portion size based on visual cues
+4. Focus on accuracy over specificity for unusual items
+
+Return a JSON response with this structure:
+[
+    {
+        "name": "Specific common food name (e.g., 'grilled chicken breast', 'white rice', 'broccoli')",
+        "estimated_weight_grams": your_visual_estimate,
+        "confidence": confidence_score_0_to_1,
+        "preparation_method": "raw|cooked|fried|steamed|grilled|boiled|etc",
+        "food_category": "protein|grain|vegetable|fruit|dairy|fat|other",
+        "visual_cues": "brief description of what you see"
+    }
+]
+
+Guidelines:
+- Use common, searchable food names that would be in USDA database
+- For mixed dishes, break them down into main components if possible
+- Estimate portion sizes using plate size, utensils, hand size as reference
+- Be conservative with confidence scores for unclear items
+- Return ONLY the JSON array, no additional text
+"""
+
+# The request parts that never change, built once; httpx only reads them when
+# serializing, so every request can share them
+GEMINI_PROMPT_PART = {"text": GEMINI_PROMPT}
+GEMINI_GENERATION_CONFIG = {
+    "temperature": 0.1,
+    "topK": 32,
+    "topP": 1,
+    "maxOutputTokens": 2048,
+    # Structured output: a bare JSON array of food items, no fences or prose
+    "responseMimeType": "application/json",
+    "responseSchema": {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {
+                "name": {"type": "STRING"},
+                "estimated_weight_grams": {"type": "NUMBER"},
+                "confidence": {"type": "NUMBER"},
+                "preparation_method": {"type": "STRING"},
+                "food_category": {"type": "STRING"},
+                "visual_cues": {"type": "STRING"}
+            },
+            "required": ["name", "estimated_weight_grams", "confidence"]
+        }
+    }
+}
+
+# Fields every Gemini food item needs, with the types the nutrition math expects
+REQUIRED_FOOD_FIELDS = (
+    ('name', str),
+    ('estimated_weight_grams', (int, float)),
+    ('confidence', (int, float))
+)
+
+# Enhanced results per image content hash, so re-uploads skip Gemini and USDA.
+# Only touched from EVENT_LOOP, so no lock is needed
+IMAGE_RESULT_CACHE = TTLCache(maxsize=256, ttl=1800)
+
+# Clients may reuse an analysis for a while without asking again
+ANALYSIS_CACHE_CONTROL = "private, max-age=600"
+
+# Analyses still running per image content hash, so concurrent duplicates share one
+IMAGE_ANALYSES_IN_FLIGHT = {}
+
+@dataclass(slots=True)
+class UsdaFood:
+    """One processed USDA search hit; cached and compared internally, never serialized"""
+    fdc_id: int | None
+    ndb_number: str
+    description: str
+    nutrients: dict
+    data_source: str
+    database_priority: int
+    relevance_score: int
+
+def run_async(coro, timeout=None):
+    """Run a coroutine on the shared event loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, EVENT_LOOP).result(timeout)
+
+@atexit.register
+def close_clients():
+    """Close pooled connections when the instance shuts down"""
+    run_async(GEMINI_CLIENT.aclose(), timeout=5)
+    run_async(USDA_CLIENT.aclose(), timeout=5)
+
+async def warm_connections():
+    """Open the pooled Gemini and USDA connections before the first request needs them"""
+    results = await asyncio.gather(
+        GEMINI_CLIENT.head(GEMINI_ORIGIN),
+        USDA_CLIENT.head("/"),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.debug("Connection warm-up failed: %s", result)
+
+# Serving instances (not the deploy-time import) resolve DNS and finish the TLS
+# handshakes during init; the import doesn't wait for it
+if os.environ.get('K_SERVICE'):
+    asyncio.run_coroutine_threadsafe(warm_connections(), EVENT_LOOP)
+
+# Logging functions: one entry per event, formatted only when DEBUG is enabled
 def log_function_call(function_name, **kwargs):
     """Log when functions are called"""
-    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-    print(f"🟢 [{timestamp}] FUNCTION CALLED: {function_name}")
-    for key, value in kwargs.items():
-        print(f"   📝 {key}: {value}")
+    logger.debug("🟢 FUNCTION CALLED: %s %s", function_name, kwargs)
 
 def log_api_call(api_name, url, status_code, response_time=None):
     """Log API calls"""
-    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-    print(f"🔵 [{timestamp}] API CALL: {api_name}")
-    print(f"   🌐 URL: {url}")
-    print(f"   📊 Status: {status_code}")
-    if response_time:
-        print(f"   ⏱️ Time: {response_time:.2f}s")
+    logger.debug(
+        "🔵 API CALL: %s %s -> %s in %.2fs", api_name, url, status_code, response_time or 0,
+        extra={"api": api_name, "url": url, "status": status_code, "seconds": response_time}
+    )
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -52,35 +295,46 @@ def health_check():
 @app.route('/analyze-food', methods=['POST'])
 def analyze_food():
     try:
-        print("=== Starting Enhanced USDA-Only Food Analysis ===")
+        logger.debug("=== Starting Enhanced USDA-Only Food Analysis ===")
         
-        # Get JSON data
-        try:
-            data = request.get_json(force=True)
-            print(f"Received data keys: {list(data.keys()) if data else 'No data'}")
-        except Exception as e:
-            print(f"JSON parsing error: {str(e)}")
-            return jsonify({'error': f'Invalid JSON: {str(e)}'}), 400
-        
-        if not data:
-            print("No data provided")
-            return jsonify({'error': 'No data provided'}), 400
-        
-        image_data = data.get('image')
-        if not image_data:
-            print("No image provided in data")
-            return jsonify({'error': 'No image provided'}), 400
-        
-        print(f"Image data length: {len(image_data) if image_data else 0}")
-        
-        # Remove data URL prefix if present
-        if 'base64,' in image_data:
-            image_data = image_data.split('base64,')[1]
-            print("Removed data URL prefix")
+        # Raw image uploads skip the base64-in-JSON detour. The bytes stay raw for
+        # hashing and shrinking; they are base64-encoded once, for Gemini
+        if request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream':
+            image_data = request.get_data()
+            if not image_data:
+                logger.warning("Empty image upload")
+                return jsonify({'error': 'No image provided'}), 400
+            
+            logger.debug("Received raw image upload of %d bytes", len(image_data))
+        else:
+            # Get JSON data
+            try:
+                data = request.get_json(force=True)
+                logger.debug("Received data keys: %s", list(data) if data else 'No data')
+            except Exception as e:
+                logger.warning("JSON parsing error: %s", e)
+                return jsonify({'error': f'Invalid JSON: {str(e)}'}), 400
+            
+            if not data:
+                logger.warning("No data provided")
+                return jsonify({'error': 'No data provided'}), 400
+            
+            image_data = data.get('image')
+            if not image_data:
+                logger.warning("No image provided in data")
+                return jsonify({'error': 'No image provided'}), 400
+            
+            logger.debug("Image data length: %d", len(image_data))
+            
+            # Remove data URL prefix if present
+            _, prefix, encoded = image_data.partition('base64,')
+            if prefix:
+                image_data = encoded
+                logger.debug("Removed data URL prefix")
         
         # For testing, if image is just "test", return mock data
         if image_data == "test":
-            print("Using test mock data")
+            logger.debug("Using test mock data")
             mock_results = [{
                 "name": "Test Food Item",
                 "calories_per_100g": 200,
@@ -105,33 +359,49 @@ def analyze_food():
                 'nutrition_database': 'Test'
             })
         
+        # The analysis of an image doesn't change, so a client that already holds
+        # it can revalidate without running Gemini or USDA again
+        image_key = image_hash(image_data)
+        if request.if_none_match.contains(image_key):
+            logger.debug("Client already has the analysis of image %s", image_key)
+            response = app.response_class(status=304)
+            response.set_etag(image_key)
+            response.headers['Cache-Control'] = ANALYSIS_CACHE_CONTROL
+            return response
+        
         # Check API keys
         if not GEMINI_API_KEY:
-            print("ERROR: No Gemini API key configured")
+            logger.error("No Gemini API key configured")
             return jsonify({
                 'success': True,
                 'foods': get_fallback_response("No Gemini API key configured")
             })
         
-        print("API keys loaded from secure secrets")
-        print("Starting Enhanced Gemini analysis...")
+        logger.debug("API keys loaded from secure secrets")
+        logger.debug("Starting Enhanced Gemini analysis...")
         
         # Analyze food with enhanced Gemini + comprehensive USDA search
-        results = analyze_with_enhanced_gemini(image_data)
+        results, fully_matched = run_async(analyze_for_response(image_data, image_key))
         
-        print(f"Enhanced analysis completed, found {len(results)} food items")
+        logger.debug("Enhanced analysis completed, found %d food items", len(results))
         
-        return jsonify({
+        response = jsonify({
             'success': True,
             'foods': results,
             'enhanced': True,
             'nutrition_database': 'USDA_Multi_Database' if USDA_API_KEY else 'Disabled'
         })
         
+        # Fallbacks and per-item estimates come from transient failures; only a
+        # fully matched analysis is worth the client keeping
+        if fully_matched:
+            response.set_etag(image_key)
+            response.headers['Cache-Control'] = ANALYSIS_CACHE_CONTROL
+        
+        return response
+        
     except Exception as e:
-        print(f"ERROR in analyze_food: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.error("ERROR in analyze_food: %s", e, exc_info=DEBUG)
         return jsonify({'error': f'Internal server error: {str(e)}'}), 500
 
 @app.route('/', methods=['GET', 'POST'])
@@ -149,6 +419,72 @@ def default_route():
     elif request.method == 'POST':
         return analyze_food()
 
+async def search_usda_database(food_name, db_info, max_results_per_db):
+    """Search a single USDA database and return its processed food items"""
+    db_name = db_info["name"]
+    priority = db_info["priority"]
+    
+    logger.debug("📊 Searching Database %d/%d: %s", priority, len(USDA_DATABASES), db_name)
+    
+    params = {
+        "query": food_name,
+        "dataType": db_info["dataType"],
+        "pageSize": max_results_per_db,
+        "sortBy": "dataType.keyword",
+        "sortOrder": "asc",
+        "api_key": USDA_API_KEY
+    }
+    
+    cache_key = (food_name, db_info["dataType"], max_results_per_db)
+    cached_foods = USDA_DATABASE_CACHE.get(cache_key)
+    if cached_foods is not None:
+        logger.debug("✅ %s: %d results served from cache", db_name, len(cached_foods))
+        return cached_foods
+    
+    # Revalidate a previous answer instead of downloading it again
+    cached_etag = USDA_ETAG_CACHE.get(cache_key)
+    headers = {"If-None-Match": cached_etag[0]} if cached_etag else None
+    
+    async with USDA_SEMAPHORE:
+        start_time = time.time()
+        response = await USDA_CLIENT.get("/foods/search", params=params, headers=headers)
+    
+    search_time = time.time() - start_time
+    log_api_call(f"USDA {db_name}", f"{USDA_BASE_URL}/foods/search", response.status_code, search_time)
+    
+    if response.status_code == 304 and cached_etag:
+        logger.debug("✅ %s: not modified, reusing %d cached results", db_name, len(cached_etag[1]))
+        USDA_DATABASE_CACHE[cache_key] = cached_etag[1]
+        return cached_etag[1]
+    
+    response.raise_for_status()
+    api_data = orjson.loads(response.content)
+    
+    foods = api_data.get("foods", [])
+    total_hits = api_data.get("totalHits", 0)
+    
+    logger.debug("✅ %s: %d results (total hits: %s)", db_name, len(foods), total_hits)
+    
+    # Process results from this database
+    processed_foods = []
+    for food in foods:
+        processed_food = process_usda_food_item(food, db_name, priority)
+        if processed_food:
+            processed_foods.append(processed_food)
+            
+            # Log NDB number and FDC ID for tracking
+            logger.debug(
+                "📋 Found: %s (FDC ID %s, NDB %s, %s)",
+                processed_food.description, processed_food.fdc_id, processed_food.ndb_number, db_name
+            )
+    
+    etag = response.headers.get("ETag")
+    if etag:
+        USDA_ETAG_CACHE[cache_key] = (etag, processed_foods)
+    USDA_DATABASE_CACHE[cache_key] = processed_foods
+    
+    return processed_foods
+
 async def comprehensive_usda_search(food_name, max_results_per_db=10):
     """
     Search across multiple USDA databases with comprehensive logging
@@ -161,102 +497,110 @@ async def comprehensive_usda_search(food_name, max_results_per_db=10):
     
     try:
         if not USDA_API_KEY:
-            print("❌ No USDA API key available")
+            logger.error("❌ No USDA API key available")
             return {"status": "error", "error": "No USDA API key"}
         
-        # Define database search order (priority-based)
-        database_searches = [
-            {"name": "Foundation", "dataType": "Foundation", "priority": 1},
-            {"name": "SR Legacy", "dataType": "SR Legacy", "priority": 2}, 
-            {"name": "Survey (FNDDS)", "dataType": "Survey (FNDDS)", "priority": 3},
-            {"name": "Branded", "dataType": "Branded", "priority": 4}
+        # USDA search is case-insensitive, so normalized names share cache entries
+        food_name = food_name.strip().lower()
+        cache_key = (food_name, max_results_per_db)
+        cached_search = USDA_SEARCH_CACHE.get(cache_key)
+        if cached_search is not None:
+            logger.debug("✅ USDA results for '%s' served from cache", food_name)
+            return cached_search
+        
+        logger.debug("🔍 Searching %d USDA databases concurrently for '%s'", len(USDA_DATABASES), food_name)
+        
+        # The databases are independent, so query them all at once: the search
+        # takes as long as the slowest database instead of the sum of all four
+        searches = [
+            asyncio.ensure_future(search_usda_database(food_name, db_info, max_results_per_db))
+            for db_info in USDA_DATABASES
         ]
         
-        all_results = []
-        best_match = None
-        
-        print(f"🔍 Starting comprehensive USDA search for: '{food_name}'")
-        print(f"🗃️ Will search {len(database_searches)} databases in priority order")
-        
-        async with httpx.AsyncClient() as client:
-            for db_info in database_searches:
-                db_name = db_info["name"]
-                data_type = db_info["dataType"]
-                priority = db_info["priority"]
-                
-                print(f"\n📊 Searching Database {priority}/4: {db_name}")
-                start_time = time.time()
-                
-                try:
-                    params = {
-                        "query": food_name,
-                        "dataType": data_type,
-                        "pageSize": max_results_per_db,
-                        "sortBy": "dataType.keyword",
-                        "sortOrder": "asc",
-                        "api_key": USDA_API_KEY
-                    }
-                    
-                    response = await client.get(f"{USDA_BASE_URL}/foods/search", params=params, timeout=15)
-                    
-                    search_time = time.time() - start_time
-                    log_api_call(f"USDA {db_name}", f"{USDA_BASE_URL}/foods/search", response.status_code, search_time)
-                    
-                    response.raise_for_status()
-                    api_data = response.json()
-                    
-                    foods = api_data.get("foods", [])
-                    total_hits = api_data.get("totalHits", 0)
-                    
-                    print(f"   ✅ {db_name}: {len(foods)} results (total hits: {total_hits})")
-                    
-                    # Process results from this database
-                    for food in foods:
-                        processed_food = process_usda_food_item(food, db_name, priority)
-                        if processed_food:
-                            all_results.append(processed_food)
-                            
-                            # Log NDB number and FDC ID for tracking
-                            fdc_id = food.get("fdcId", "Unknown")
-                            ndb_number = food.get("ndbNumber", "N/A")
-                            description = food.get("description", "Unknown")
-                            
-                            print(f"   📋 Found: {description}")
-                            print(f"      🔢 FDC ID: {fdc_id}")
-                            print(f"      🏷️ NDB Number: {ndb_number}")
-                            print(f"      🗃️ Database: {db_name}")
-                            
-                            # Set best match if we don't have one yet (first result from highest priority DB)
-                            if best_match is None:
-                                best_match = processed_food
-                                print(f"   ⭐ Set as BEST MATCH (Database: {db_name}, Priority: {priority})")
-                
-                except Exception as e:
-                    print(f"   ❌ Error searching {db_name}: {str(e)}")
-                    continue
+        # Foundation outranks every other database, so whenever it returns anything
+        # its first hit is the best match and the rest would only pad all_results;
+        # stop waiting for them
+        foundation_foods = (await asyncio.gather(searches[0], return_exceptions=True))[0]
+        if not isinstance(foundation_foods, Exception) and foundation_foods:
+            logger.debug("⭐ Foundation matched '%s', skipping other databases", food_name)
+            for search in searches[1:]:
+                search.cancel()
+            db_results = [foundation_foods] + [None] * (len(searches) - 1)
+        else:
+            db_results = await asyncio.gather(*searches, return_exceptions=True)
         
-        # Sort all results by database priority, then by relevance
-        all_results.sort(key=lambda x: (x.get("database_priority", 99), -x.get("relevance_score", 0)))
-        
-        print(f"\n📈 SEARCH SUMMARY:")
-        print(f"   📊 Total results found: {len(all_results)}")
-        print(f"   🏆 Best match database: {best_match.get('data_source', 'None') if best_match else 'None'}")
-        print(f"   🔢 Best match FDC ID: {best_match.get('fdc_id', 'None') if best_match else 'None'}")
-        print(f"   🏷️ Best match NDB: {best_match.get('ndb_number', 'None') if best_match else 'None'}")
-        
-        return {
-            "status": "success",
-            "total_results": len(all_results),
-            "best_match": best_match,
-            "all_results": all_results[:20],  # Return top 20 results
-            "databases_searched": [db["name"] for db in database_searches],
-            "search_query": food_name
-        }
+        search_result = summarize_usda_search(food_name, db_results)
+        
+        # Don't pin a partial answer for a day because one database had a blip
+        if not any(isinstance(result, Exception) for result in db_results):
+            USDA_SEARCH_CACHE[cache_key] = search_result
+        
+        return search_result
             
     except Exception as e:
-        print(f"❌ Comprehensive USDA search error: {str(e)}")
+        logger.error("❌ Comprehensive USDA search error: %s", e)
         return {"status": "error", "error": str(e)}
 
+def summarize_usda_search(food_name, db_results):
+    """
+    Merge per-database results, given in USDA_DATABASES order, into one search result.
+    None marks a database that was skipped
+    """
+    all_results = []
+    best_match = None
+    
+    # Walk the results in priority order so the best match stays deterministic
+    for db_info, processed_foods in zip(USDA_DATABASES, db_results):
+        if processed_foods is None:
+            continue
+        if isinstance(processed_foods, Exception):
+            logger.warning("❌ Error searching %s: %s", db_info['name'], processed_foods)
+            continue
+        
+        all_results.extend(processed_foods)
+        
+        # Best match is the first result from the highest priority database
+        if best_match is None and processed_foods:
+            best_match = processed_foods[0]
+    
+    # Top results by database priority, then by relevance; only these are
+    # returned, so select them instead of sorting everything
+    top_results = heapq.nsmallest(
+        MAX_SEARCH_RESULTS, all_results,
+        key=lambda x: (x.database_priority, -x.relevance_score)
+    )
+    
+    if best_match:
+        logger.debug(
+            "📈 '%s': %d results, best match %s from %s (FDC ID %s, NDB %s)",
+            food_name, len(all_results), best_match.description, best_match.data_source,
+            best_match.fdc_id, best_match.ndb_number
+        )
+    else:
+        logger.debug("📈 '%s': %d results, no best match", food_name, len(all_results))
+    
+    return {
+        "status": "success",
+        "total_results": len(all_results),
+        "best_match": best_match,
+        "all_results": top_results,
+        "databases_searched": [
+            db["name"] for db, processed_foods in zip(USDA_DATABASES, db_results) if processed_foods is not None
+        ],
+        "search_query": food_name
+    }
+
+# USDA reports a few hundred distinct nutrient names, so each is lowercased and
+# scanned once per instance instead of once per food
+@lru_cache(maxsize=None)
+def classify_nutrient(nutrient_name):
+    """Map a USDA nutrient name to its standard key, or None"""
+    nutrient_name = nutrient_name.lower()
+    for keyword, key, exclude in NUTRIENT_KEYWORDS:
+        if keyword in nutrient_name and not (exclude and exclude in nutrient_name):
+            return key
+    return None
+
 def process_usda_food_item(food, database_name, priority):
     """Process a single USDA food item and extract relevant nutrition data"""
     try:
@@ -267,286 +611,413 @@ def process_usda_food_item(food, database_name, priority):
         # Extract nutrients
         nutrients = {}
         for nutrient in food.get("foodNutrients", []):
-            nutrient_name = nutrient.get("nutrientName", "").lower()
-            nutrient_value = nutrient.get("value", 0)
-            nutrient_unit = nutrient.get("unitName", "")
-            
-            # Map nutrient names to standard keys
-            if "energy" in nutrient_name or "calorie" in nutrient_name:
-                nutrients["calories"] = {"value": nutrient_value, "unit": nutrient_unit}
-            elif "protein" in nutrient_name:
-                nutrients["protein"] = {"value": nutrient_value, "unit": nutrient_unit}
-            elif "carbohydrate" in nutrient_name:
-                nutrients["carbohydrates"] = {"value": nutrient_value, "unit": nutrient_unit}
-            elif "total lipid" in nutrient_name or ("fat" in nutrient_name and "sat" not in nutrient_name):
-                nutrients["fat"] = {"value": nutrient_value, "unit": nutrient_unit}
-            elif "fiber" in nutrient_name:
-                nutrients["fiber"] = {"value": nutrient_value, "unit": nutrient_unit}
+            # Map nutrient names to standard keys. The first entry wins: Energy in
+            # KCAL comes before Energy in kJ, Total lipid before the fatty acids
+            key = classify_nutrient(nutrient.get("nutrientName", ""))
+            if key and key not in nutrients:
+                nutrients[key] = {"value": nutrient.get("value", 0), "unit": nutrient.get("unitName", "")}
+                # Foods can list 100+ nutrients; stop once every tracked one is found
+                if len(nutrients) == len(NUTRIENT_KEYS):
+                    break
         
         # Calculate relevance score (higher = better)
         relevance_score = calculate_relevance_score(description, database_name)
         
-        return {
-            "fdcId": fdc_id,
-            "ndb_number": ndb_number,
-            "description": description,
-            "dataType": food.get("dataType"),
-            "nutrients": nutrients,
-            "data_source": f"USDA_{database_name.replace(' ', '_')}",
-            "database_priority": priority,
-            "relevance_score": relevance_score,
-            "brandOwner": food.get("brandOwner"),
-            "ingredients": food.get("ingredients"),
-            "servingSize": food.get("servingSize"),
-            "servingSizeUnit": food.get("servingSizeUnit")
-        }
+        return UsdaFood(
+            fdc_id=fdc_id,
+            ndb_number=ndb_number,
+            description=description,
+            nutrients=nutrients,
+            data_source=f"USDA_{database_name.replace(' ', '_')}",
+            database_priority=priority,
+            relevance_score=relevance_score
+        )
         
     except Exception as e:
-        print(f"❌ Error processing food item: {str(e)}")
+        logger.warning("❌ Error processing food item: %s", e)
         return None
 
 def calculate_relevance_score(description, database_name):
     """Calculate relevance score for ranking results"""
-    score = 0
-    
     # Database priority scoring
-    db_scores = {
-        "Foundation": 100,
-        "SR Legacy": 80, 
-        "Survey (FNDDS)": 60,
-        "Branded": 40
-    }
-    score += db_scores.get(database_name, 0)
-    
-    # Description quality scoring
+    return DATABASE_RELEVANCE_SCORES.get(database_name, 0) + description_relevance(description)
+
+# The same descriptions come back across databases, plates and requests, so
+# each distinct one is scored once per instance
+@lru_cache(maxsize=4096)
+def description_relevance(description):
+    """Description quality part of the relevance score"""
+    score = 0
     desc_lower = description.lower()
     
     # Prefer shorter, more specific descriptions
-    if len(description) < 50:
+    length = len(description)
+    if length < 50:
         score += 20
-    elif len(description) < 100:
+    elif length < 100:
         score += 10
     
     # Prefer entries without brand names or complex modifiers
-    if not any(word in desc_lower for word in ["brand", "inc.", "corp", "company", "ltd"]):
+    if not BRAND_WORDS_RE.search(desc_lower):
         score += 15
     
     # Prefer raw/basic foods over processed
-    if any(word in desc_lower for word in ["raw", "fresh", "plain"]):
+    if BASIC_FOOD_WORDS_RE.search(desc_lower):
         score += 10
     
     return score
 
-def analyze_with_enhanced_gemini(base64_image):
-    """Enhanced Gemini analysis with comprehensive USDA search"""
+def looks_like_base64(data):
+    """Cheap structural base64 check that never decodes the (multi-MB) image"""
+    if not data or len(data) % 4 == 1:
+        return False
+    
+    # Checking both ends catches non-base64 input without scanning the whole image
+    return bool(BASE64_RE.fullmatch(data[:BASE64_CHECK_CHARS]) and BASE64_RE.fullmatch(data[-BASE64_CHECK_CHARS:]))
+
+def estimated_decoded_size(base64_image):
+    """Byte size the base64 image decodes to, worked out from its length alone"""
+    return len(base64_image) * 3 // 4 - base64_image[-2:].count('=')
+
+def to_base64(image):
+    """The upload as the base64 text Gemini takes, encoding raw bytes if needed"""
+    return base64.b64encode(image).decode() if isinstance(image, bytes) else image
+
+def shrink_image(image):
+    """
+    Downscale and recompress a large upload so less data is sent to Gemini.
+    Takes the upload as raw bytes or base64 and returns it as base64
+    """
+    raw_image = image if isinstance(image, bytes) else None
+    image_size = len(raw_image) if raw_image is not None else estimated_decoded_size(image)
+    if image_size < SMALL_IMAGE_BYTES:
+        return to_base64(image)
+    
+    # Pillow is only needed for large uploads, so cold starts don't pay for importing it
+    from PIL import Image, ImageOps
+    
+    try:
+        if raw_image is None:
+            raw_image = base64.b64decode(image + '==')
+        with Image.open(io.BytesIO(raw_image)) as img:
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((GEMINI_IMAGE_MAX_SIDE, GEMINI_IMAGE_MAX_SIDE))
+            buffer = io.BytesIO()
+            img.convert("RGB").save(buffer, "JPEG", quality=GEMINI_IMAGE_QUALITY, optimize=True)
+    except Exception as e:
+        logger.warning("Could not shrink image, sending original: %s", e)
+        return to_base64(image)
+    
+    small_image = buffer.getvalue()
+    logger.debug("Shrunk image from %d to %d bytes", len(raw_image), len(small_image))
+    if len(small_image) >= len(raw_image):
+        return to_base64(image)
+    return base64.b64encode(small_image).decode()
+
+def image_hash(image):
+    """Content hash of the uploaded image (raw bytes or base64), used as its cache key and ETag"""
+    return hashlib.blake2b(image if isinstance(image, bytes) else image.encode(), digest_size=16).hexdigest()
+
+async def analyze_for_response(image, image_key):
+    """Analyze the image and report whether the answer is fully matched and reusable"""
+    results = await analyze_with_enhanced_gemini(image, image_key)
+    # Only fully matched analyses enter the result cache; checked here on
+    # EVENT_LOOP, the only thread that touches it
+    return results, image_key in IMAGE_RESULT_CACHE
+
+async def analyze_with_enhanced_gemini(image, image_key=None):
+    """
+    Enhanced Gemini analysis with comprehensive USDA search
+    The image is the raw uploaded bytes or a base64 string
+    """
     
     log_function_call("analyze_with_enhanced_gemini", 
-                     image_size=f"{len(base64_image)} characters")
+                     image_size=f"{len(image)} {'bytes' if isinstance(image, bytes) else 'characters'}")
     
-    print("=== Enhanced Gemini Analysis with Comprehensive USDA Search ===")
-    print("🔍 ANALYSIS FLOW:")
-    print("   1. Gemini Vision API → Food identification")
-    print("   2. Comprehensive USDA Multi-Database Search")
-    print("   3. NDB Number Logging & Best Match Selection")
-    print("   4. Enhanced nutrition data integration")
+    logger.debug("=== Enhanced Gemini Analysis with Comprehensive USDA Search ===")
     
     if not GEMINI_API_KEY:
-        print("❌ ERROR: No Gemini API key available")
+        logger.error("❌ No Gemini API key available")
         return get_fallback_response("No Gemini API key configured")
     
-    # Validate base64 image
-    try:
-        decoded = base64.b64decode(base64_image + '==')
-        print(f"Base64 image decoded successfully, size: {len(decoded)} bytes")
-    except Exception as e:
-        print(f"ERROR: Invalid base64 image: {str(e)}")
-        return get_fallback_response("Invalid image format")
-    
-    # Enhanced prompt for better food identification
-    prompt = """
-    Analyze this food image and identify all visible food items with maximum accuracy.
-
-    For each food item you identify:
-    1. Provide the most specific, common food name possible (avoid brand names)
-    2. Use standard food terminology that would be found in nutrition databases
-    3. Estimate the portion size based on visual cues
-    4. Focus on accuracy over specificity for unusual items
-
-    Return a JSON response with this structure:
-    [
-        {
-            "name": "Specific common food name (e.g., 'grilled chicken breast', 'white rice', 'broccoli')",
-            "estimated_weight_grams": your_visual_estimate,
-            "confidence": confidence_score_0_to_1,
-            "preparation_method": "raw|cooked|fried|steamed|grilled|boiled|etc",
-            "food_category": "protein|grain|vegetable|fruit|dairy|fat|other",
-            "visual_cues": "brief description of what you see"
-        }
-    ]
-
-    Guidelines:
-    - Use common, searchable food names that would be in USDA database
-    - For mixed dishes, break them down into main components if possible
-    - Estimate portion sizes using plate size, utensils, hand size as reference
-    - Be conservative with confidence scores for unclear items
-    - Return ONLY the JSON array, no additional text
-    """
+    # Validate base64 image; raw uploads are left for Pillow and Gemini to judge
+    if not isinstance(image, bytes):
+        if not looks_like_base64(image):
+            logger.warning("Invalid base64 image")
+            return get_fallback_response("Invalid image format")
+        logger.debug("Base64 image looks valid, ~%d bytes", estimated_decoded_size(image))
     
+    image_key = image_key or image_hash(image)
+    cached_results = IMAGE_RESULT_CACHE.get(image_key)
+    if cached_results is not None:
+        logger.debug("✅ Image %s already analyzed, returning cached results", image_key)
+        return cached_results
+    
+    # A client retrying while the first upload is still being analyzed joins that
+    # analysis instead of paying for a second Gemini call
+    analysis = IMAGE_ANALYSES_IN_FLIGHT.get(image_key)
+    if analysis is None:
+        analysis = asyncio.ensure_future(analyze_image(image, image_key))
+        IMAGE_ANALYSES_IN_FLIGHT[image_key] = analysis
+        analysis.add_done_callback(lambda _: IMAGE_ANALYSES_IN_FLIGHT.pop(image_key, None))
+    else:
+        logger.debug("⏳ Image %s is already being analyzed, waiting for it", image_key)
+    
+    # Shielded so one caller timing out doesn't cancel the analysis for the others
+    return await asyncio.shield(analysis)
+
+async def analyze_image(image, image_key):
+    """Run Gemini and the USDA enhancement for a validated image and cache the results"""
+    # Pillow work and base64 encoding are CPU-bound; keep them off the event loop
+    # serving other requests
+    gemini_image = await asyncio.get_running_loop().run_in_executor(IMAGE_EXECUTOR, shrink_image, image)
+    
+    # Only the image part changes between requests
     payload = {
         "contents": [
             {
                 "parts": [
-                    {
-                        "text": prompt
-                    },
+                    GEMINI_PROMPT_PART,
                     {
                         "inline_data": {
                             "mime_type": "image/jpeg",
-                            "data": base64_image
+                            "data": gemini_image
                         }
                     }
                 ]
             }
         ],
-        "generationConfig": {
-            "temperature": 0.1,
-            "topK": 32,
-            "topP": 1,
-            "maxOutputTokens": 2048,
-        }
-    }
-    
-    headers_req = {
-        'Content-Type': 'application/json',
+        "generationConfig": GEMINI_GENERATION_CONFIG
     }
     
     try:
-        print("📡 STEP 1: Calling Gemini Vision API...")
+        logger.debug("📡 STEP 1: Calling Gemini Vision API...")
         start_time = time.time()
         
-        response = requests.post(
-            f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
-            headers=headers_req,
+        # Gemini streams its answer as server-sent events; each food item's USDA
+        # search starts as soon as the item's closing brace arrives, so the
+        # lookups overlap with the rest of Gemini's reply
+        scanner = JsonObjectScanner()
+        usda_searches = {}
+        text_parts = []
+        async with GEMINI_CLIENT.stream(
+            "POST",
+            GEMINI_API_URL,
+            params={"key": GEMINI_API_KEY, "alt": "sse"},
             json=payload,
             timeout=30
-        )
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                chunk = orjson.loads(line[5:])
+                # The closing event may carry only a finish reason and no content
+                for part in chunk['candidates'][0].get('content', {}).get('parts', []):
+                    text = part.get('text', '')
+                    text_parts.append(text)
+                    for item_json in scanner.feed(text):
+                        prefetch_usda_search(item_json, usda_searches)
         
         gemini_time = time.time() - start_time
         log_api_call("Gemini Vision", GEMINI_API_URL, response.status_code, gemini_time)
         
-        if response.status_code == 200:
-            result = response.json()
+        if text_parts:
+            text_response = "".join(text_parts)
+            logger.debug("✅ Gemini analysis complete, %d USDA searches already started", len(usda_searches))
+            
+            # Parse initial response
+            initial_results = parse_gemini_response(text_response)
+            logger.debug("📋 Gemini identified %d food items", len(initial_results))
             
-            if 'candidates' in result and len(result['candidates']) > 0:
-                text_response = result['candidates'][0]['content']['parts'][0]['text']
-                print(f"✅ Gemini analysis complete")
-                
-                # Parse initial response
-                initial_results = parse_gemini_response(text_response)
-                print(f"📋 Gemini identified {len(initial_results)} food items")
-                
-                # COMPREHENSIVE USDA NUTRITION ENHANCEMENT
-                print("📡 STEP 2: Enhancing with comprehensive USDA database search...")
-                enhanced_results = asyncio.run(enhance_with_comprehensive_usda(initial_results))
-                
-                return enhanced_results
-            else:
-                print("❌ ERROR: No candidates in Gemini response")
-                return get_fallback_response("No response from AI")
+            # COMPREHENSIVE USDA NUTRITION ENHANCEMENT
+            logger.debug("📡 STEP 2: Enhancing with comprehensive USDA database search...")
+            enhanced_results, all_matched = await enhance_with_comprehensive_usda(
+                initial_results or get_default_item(), usda_searches
+            )
+            
+            # Placeholder items from a parse failure or a USDA outage would outlive
+            # the problem, so only a fully matched analysis is reused
+            if initial_results and all_matched:
+                IMAGE_RESULT_CACHE[image_key] = enhanced_results
+            return enhanced_results
         else:
-            print(f"❌ Gemini API error: {response.status_code}")
-            return get_fallback_response(f"API error: {response.status_code}")
+            logger.error("❌ No candidates in Gemini response")
+            return get_fallback_response("No response from AI")
             
-    except Exception as e:
-        print(f"❌ ERROR: Gemini request failed: {str(e)}")
+    except httpx.TimeoutException:
+        logger.error("❌ Gemini request timed out")
+        return get_fallback_response("Request timed out")
+    except httpx.ConnectError as e:
+        logger.error("❌ Could not connect to Gemini: %s", e)
+        return get_fallback_response(f"Connection error: {str(e)}")
+    except httpx.HTTPStatusError as e:
+        logger.error("❌ Gemini API error: %d", e.response.status_code)
+        return get_fallback_response(f"API error: {e.response.status_code}")
+    except httpx.HTTPError as e:
+        logger.error("❌ Gemini request failed: %s", e)
         return get_fallback_response(f"Request error: {str(e)}")
+    except (orjson.JSONDecodeError, KeyError, IndexError) as e:
+        logger.error("❌ Unexpected Gemini response: %s", e)
+        return get_fallback_response("Unexpected AI response")
 
-async def enhance_with_comprehensive_usda(initial_results):
-    """Enhanced nutrition data lookup using comprehensive USDA search"""
+async def enhance_food_item(i, total, item, usda_search):
+    """
+    Scale one Gemini food item's USDA nutrition (awaited from usda_search) to its estimated weight
+    Returns the enhanced item and whether it has a real USDA match
+    """
+    food_name = item.get('name', '')
+    estimated_weight = item.get('estimated_weight_grams', 100)
+    
+    try:
+        # Comprehensive USDA search across all databases, shared by same-named items
+        nutrition_data = await usda_search
+        
+        if nutrition_data.get('status') == 'success' and nutrition_data.get('best_match'):
+            best_match = nutrition_data['best_match']
+            
+            # Extract and scale nutrition data
+            nutrients = best_match.nutrients
+            calories_per_100g = nutrients.get('calories', {}).get('value', 200)
+            
+            scaling_factor = estimated_weight / 100.0
+            total_calories = calories_per_100g * scaling_factor
+            
+            # Items are enhanced concurrently, so everything about one item goes
+            # into a single entry instead of interleaving with the others
+            logger.debug(
+                "📋 Food %d/%d '%s' (%sg): %s from %s (FDC ID %s, NDB %s), %s kcal/100g → %.1f total",
+                i, total, food_name, estimated_weight, best_match.description, best_match.data_source,
+                best_match.fdc_id, best_match.ndb_number, calories_per_100g, total_calories
+            )
+            
+            return {
+                "name": food_name,
+                "calories_per_100g": calories_per_100g,
+                "estimated_weight_grams": estimated_weight,
+                "total_calories": round(total_calories, 1),
+                "confidence": item.get('confidence', 0.8),
+                "nutrients": {
+                    "protein": round(nutrients.get('protein', {}).get('value', 0) * scaling_factor, 1),
+                    "carbs": round(nutrients.get('carbohydrates', {}).get('value', 0) * scaling_factor, 1),
+                    "fat": round(nutrients.get('fat', {}).get('value', 0) * scaling_factor, 1),
+                    "fiber": round(nutrients.get('fiber', {}).get('value', 0) * scaling_factor, 1)
+                },
+                "data_source": best_match.data_source,
+                "database_match": best_match.description,
+                "fdc_id": best_match.fdc_id,
+                "ndb_number": best_match.ndb_number,
+                "food_category": item.get('food_category', 'other'),
+                "preparation_method": item.get('preparation_method', 'unknown'),
+                "usda_search_results": len(nutrition_data.get('all_results', [])),
+                "databases_searched": nutrition_data.get('databases_searched', [])
+            }, True
+        
+        logger.debug("⚠️ Food %d/%d '%s': no USDA match found, using fallback estimates", i, total, food_name)
+        return create_fallback_item(item), False
+        
+    except Exception as e:
+        logger.warning("❌ Error processing %s: %s", food_name, e)
+        return create_fallback_item(item), False
+
+async def enhance_with_comprehensive_usda(initial_results, usda_searches=None):
+    """
+    Enhanced nutrition data lookup using comprehensive USDA search
+    usda_searches maps normalized food names to searches that are already running.
+    Returns the enhanced items and whether every one has a real USDA match
+    """
     
     log_function_call("enhance_with_comprehensive_usda", 
                      food_items=len(initial_results))
     
-    print("🔍 COMPREHENSIVE USDA ENHANCEMENT PROCESS:")
-    enhanced_results = []
+    # Every item is an independent USDA lookup; run them side by side so the
+    # plate takes as long as its slowest item rather than the sum of all items.
+    # Items with the same name (two servings of rice) share one search task
+    usda_searches = dict(usda_searches or {})
+    for item in initial_results:
+        name = item.get('name', '').strip().lower()
+        if name not in usda_searches:
+            usda_searches[name] = asyncio.ensure_future(comprehensive_usda_search(name))
     
-    for i, item in enumerate(initial_results, 1):
-        food_name = item.get('name', '')
-        estimated_weight = item.get('estimated_weight_grams', 100)
-        
-        print(f"\n📋 Processing food {i}/{len(initial_results)}: {food_name}")
-        print(f"   ⚖️ Estimated weight: {estimated_weight}g")
-        
-        try:
-            # Comprehensive USDA search across all databases
-            print("   🔍 Starting comprehensive USDA search...")
-            nutrition_data = await comprehensive_usda_search(food_name)
-            
-            if nutrition_data.get('status') == 'success' and nutrition_data.get('best_match'):
-                best_match = nutrition_data['best_match']
-                
-                print(f"   ✅ Best match found: {best_match.get('description', 'Unknown')}")
-                print(f"   🗃️ Database: {best_match.get('data_source', 'Unknown')}")
-                print(f"   🔢 FDC ID: {best_match.get('fdcId', 'Unknown')}")
-                print(f"   🏷️ NDB Number: {best_match.get('ndb_number', 'N/A')}")
-                
-                # Extract and scale nutrition data
-                nutrients = best_match.get('nutrients', {})
-                calories_per_100g = nutrients.get('calories', {}).get('value', 200)
-                
-                scaling_factor = estimated_weight / 100.0
-                total_calories = calories_per_100g * scaling_factor
-                
-                print(f"   🔥 Calories: {calories_per_100g}/100g → {total_calories:.1f} total")
-                
-                enhanced_results.append({
-                    "name": food_name,
-                    "calories_per_100g": calories_per_100g,
-                    "estimated_weight_grams": estimated_weight,
-                    "total_calories": round(total_calories, 1),
-                    "confidence": item.get('confidence', 0.8),
-                    "nutrients": {
-                        "protein": round(nutrients.get('protein', {}).get('value', 0) * scaling_factor, 1),
-                        "carbs": round((nutrients.get('carbohydrates', {}).get('value', 0)) * scaling_factor, 1),
-                        "fat": round(nutrients.get('fat', {}).get('value', 0) * scaling_factor, 1),
-                        "fiber": round(nutrients.get('fiber', {}).get('value', 0) * scaling_factor, 1)
-                    },
-                    "data_source": best_match.get('data_source', 'USDA'),
-                    "database_match": best_match.get('description', ''),
-                    "fdc_id": best_match.get('fdcId'),
-                    "ndb_number": best_match.get('ndb_number', 'N/A'),
-                    "food_category": item.get('food_category', 'other'),
-                    "preparation_method": item.get('preparation_method', 'unknown'),
-                    "usda_search_results": len(nutrition_data.get('all_results', [])),
-                    "databases_searched": nutrition_data.get('databases_searched', [])
-                })
-                
-            else:
-                print(f"   ⚠️ No USDA match found, using fallback estimates")
-                enhanced_results.append(create_fallback_item(item))
-                
-        except Exception as e:
-            print(f"   ❌ Error processing {food_name}: {str(e)}")
-            enhanced_results.append(create_fallback_item(item))
-    
-    print(f"\n✅ Comprehensive enhancement complete: {len(enhanced_results)} items processed")
-    return enhanced_results
+    total = len(initial_results)
+    outcomes = await asyncio.gather(
+        *(
+            enhance_food_item(i, total, item, usda_searches[item.get('name', '').strip().lower()])
+            for i, item in enumerate(initial_results, 1)
+        )
+    )
+    enhanced_results = [enhanced_item for enhanced_item, _ in outcomes]
+    
+    logger.debug("✅ Comprehensive enhancement complete: %d items processed", len(enhanced_results))
+    return enhanced_results, all(matched for _, matched in outcomes)
+
+class JsonObjectScanner:
+    """Picks complete top-level {...} objects out of JSON text that arrives in pieces"""
+    
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.current = []
+    
+    def feed(self, text):
+        """Consume the next piece of text and return the objects it completed"""
+        objects = []
+        for char in text:
+            if self.depth:
+                self.current.append(char)
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == '{':
+                if not self.depth:
+                    self.current = [char]
+                self.depth += 1
+            elif char == '}' and self.depth:
+                self.depth -= 1
+                if not self.depth:
+                    objects.append(''.join(self.current))
+        return objects
+
+def prefetch_usda_search(item_json, usda_searches):
+    """Start the USDA search for a food item streamed by Gemini before its reply is complete"""
+    try:
+        item = orjson.loads(item_json)
+    except orjson.JSONDecodeError:
+        return
+    
+    # The full reply is validated again once it is complete; this only decides
+    # whether the item is worth searching for early
+    if not validate_food_item(item):
+        return
+    
+    name = item['name'].strip().lower()
+    if name not in usda_searches:
+        logger.debug("🔍 Gemini streamed '%s', starting its USDA search", name)
+        usda_searches[name] = asyncio.ensure_future(comprehensive_usda_search(name))
 
 def create_fallback_item(item):
     """Create fallback nutrition item when database lookup fails"""
     estimated_weight = item.get('estimated_weight_grams', 100)
+    scaling_factor = estimated_weight / 100.0
     
     return {
         "name": item.get('name', 'Unknown Food'),
         "calories_per_100g": 200,
         "estimated_weight_grams": estimated_weight,
-        "total_calories": round(200 * estimated_weight / 100, 1),
+        "total_calories": round(200 * scaling_factor, 1),
         "confidence": max(item.get('confidence', 0.5) - 0.2, 0.3),
         "nutrients": {
-            "protein": round(8 * estimated_weight / 100, 1),
-            "carbs": round(30 * estimated_weight / 100, 1),
-            "fat": round(10 * estimated_weight / 100, 1),
-            "fiber": round(4 * estimated_weight / 100, 1)
+            "protein": round(8 * scaling_factor, 1),
+            "carbs": round(30 * scaling_factor, 1),
+            "fat": round(10 * scaling_factor, 1),
+            "fiber": round(4 * scaling_factor, 1)
         },
         "data_source": "Estimated",
         "database_match": "No USDA match found",
@@ -558,51 +1029,69 @@ def create_fallback_item(item):
         "databases_searched": []
     }
 
+def extract_json_array(text_response):
+    """Cut the JSON array out of a Gemini answer wrapped in fences or prose, or None"""
+    # Clean the response to extract JSON
+    # Gemini normally wraps the whole answer in one fence; strip that with
+    # plain string ops and only fall back to the regex for anything else
+    cleaned_text = text_response.strip()
+    if cleaned_text.startswith('```') and cleaned_text.endswith('```'):
+        cleaned_text = cleaned_text.removeprefix('```json').removeprefix('```').removesuffix('```')
+    else:
+        cleaned_text = JSON_FENCE_RE.sub('', cleaned_text)
+    
+    # Find JSON array boundaries
+    json_start = cleaned_text.find('[')
+    json_end = cleaned_text.rfind(']') + 1
+    
+    if json_start != -1 and json_end > json_start:
+        return cleaned_text[json_start:json_end]
+    return None
+
 def parse_gemini_response(text_response):
-    """Parse JSON response from Gemini"""
+    """Parse JSON response from Gemini; an empty list means nothing usable was found"""
     try:
-        print("=== Parsing Gemini Response ===")
+        logger.debug("=== Parsing Gemini Response ===")
         
-        # Clean the response to extract JSON
-        cleaned_text = re.sub(r'```json\s*', '', text_response)
-        cleaned_text = re.sub(r'```\s*$', '', cleaned_text)
+        # JSON mode makes Gemini answer with the bare array, so parse it as is and
+        # only clean up answers that arrive wrapped anyway
+        try:
+            foods = orjson.loads(text_response)
+        except orjson.JSONDecodeError:
+            json_str = extract_json_array(text_response)
+            if json_str is None:
+                logger.warning("No JSON array found in response")
+                return []
+            foods = orjson.loads(json_str)
         
-        # Find JSON array boundaries
-        json_start = cleaned_text.find('[')
-        json_end = cleaned_text.rfind(']') + 1
+        if not isinstance(foods, list):
+            logger.warning("Gemini response is not a JSON array")
+            return []
         
-        if json_start != -1 and json_end > json_start:
-            json_str = cleaned_text[json_start:json_end]
-            foods = json.loads(json_str)
-            
-            # Validate results
-            validated_foods = []
-            for food in foods:
-                if validate_food_item(food):
-                    validated_foods.append(food)
-            
-            return validated_foods if validated_foods else get_default_item()
-        else:
-            print("No JSON array found in response")
-            return get_default_item()
+        # Validate results
+        validated_foods = []
+        for food in foods:
+            if validate_food_item(food):
+                validated_foods.append(food)
+        
+        return validated_foods
             
-    except json.JSONDecodeError as e:
-        print(f"JSON parsing error: {str(e)}")
-        return get_default_item()
+    except orjson.JSONDecodeError as e:
+        logger.warning("JSON parsing error: %s", e)
+        return []
 
 def validate_food_item(food):
     """Validate food item structure"""
-    required_fields = ['name', 'estimated_weight_grams', 'confidence']
+    if not isinstance(food, dict):
+        return False
     
-    for field in required_fields:
-        if field not in food:
-            return False
+    get = food.get
+    if not all(isinstance(get(field), types) for field, types in REQUIRED_FOOD_FIELDS):
+        return False
     
     # Set defaults for missing fields
-    if 'food_category' not in food:
-        food['food_category'] = 'other'
-    if 'preparation_method' not in food:
-        food['preparation_method'] = 'unknown'
+    food.setdefault('food_category', 'other')
+    food.setdefault('preparation_method', 'unknown')
     
     return True
 
@@ -618,7 +1107,7 @@ def get_default_item():
 
 def get_fallback_response(error_msg="Analysis failed"):
     """Fallback response when enhanced analysis fails"""
-    print(f"Using fallback response: {error_msg}")
+    logger.warning("Using fallback response: %s", error_msg)
     return [{
         "name": f"Food Item ({error_msg})",
         "calories_per_100g": 200,
@@ -640,16 +1129,36 @@ def get_fallback_response(error_msg="Analysis failed"):
         "databases_searched": []
     }]
 
+# The app's few routes, looked up directly by the Firebase entry point
+DIRECT_ROUTES = {
+    ('GET', '/'): default_route,
+    ('POST', '/'): default_route,
+    ('GET', '/health'): health_check,
+    ('POST', '/analyze-food'): analyze_food
+}
+
 # Firebase Functions entry point
 @https_fn.on_request(
     cors=options.CorsOptions(
         cors_origins=["*"],
         cors_methods=["POST", "GET", "OPTIONS"]
     ),
-    memory=options.MemoryOption.GB_1,
+    # CPU defaults to 1 up to 2 GB, so ask for 2 explicitly: imports and Pillow work
+    # run faster on cold starts. One warm instance keeps most requests off the
+    # cold path entirely
+    memory=options.MemoryOption.GB_2,
+    cpu=2,
     timeout_sec=120,
+    min_instances=1,
+    max_instances=10,
+    concurrency=20,
     secrets=["GEMINI_API_KEY", "USDA_API_KEY"]
 )
 def food_analyzer(req):
+    view = DIRECT_ROUTES.get((req.method, req.path))
     with app.request_context(req.environ):
-        return app.full_dispatch_request()
\ No newline at end of file
+        # Known routes skip URL matching and the request hooks; everything else
+        # (404s, 405s, OPTIONS) still gets Flask's full handling
+        if view is None:
+            return app.full_dispatch_request()
+        return app.make_response(view())
\ No newline at end of file
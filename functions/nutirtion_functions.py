@@ -2,18 +2,215 @@
 
 from firebase_functions import https_fn, options
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+import orjson
+from cachetools import TTLCache
+from dataclasses import dataclass
 import httpx
 import asyncio
+import atexit
 import os
+import re
+import threading
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, so jsonify and get_json skip stdlib json"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # orjson already returns bytes; skip the str round trip dumps() needs
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype=self.mimetype)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # USDA API Configuration
 USDA_API_KEY = os.environ.get('USDA_API_KEY')
 USDA_BASE_URL = "https://api.nal.usda.gov/fdc/v1"
 
+# Most foods a nutrition search ever returns to the client
+MAX_FOOD_RESULTS = 10
+
+# One event loop for the whole instance, so pooled connections outlive a single request
+EVENT_LOOP = asyncio.new_event_loop()
+threading.Thread(target=EVENT_LOOP.run_forever, name="usda-event-loop", daemon=True).start()
+
+# Shared USDA client, created at cold start and reused by every invocation
+USDA_CLIENT = httpx.AsyncClient(
+    base_url=USDA_BASE_URL,
+    timeout=httpx.Timeout(15.0),
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    # JSON bodies shrink several-fold compressed; httpx decodes br via the brotli extra
+    headers={"Accept-Encoding": "gzip, br"},
+    http2=True
+)
+
+# Cuisine words a description must contain to count as an Asian/Malaysian food.
+# The tuple keeps the USDA query string stable; the set is for filtering
+ASIAN_CUISINE_TERMS = ("malaysian", "asian", "chinese", "thai", "indonesian")
+ASIAN_TERMS = frozenset(ASIAN_CUISINE_TERMS)
+WORD_RE = re.compile(r'[a-z]+')
+
+# Formatted search results; USDA data is effectively static for hours. Only
+# touched from EVENT_LOOP, so no lock is needed around them
+NUTRITION_CACHE = TTLCache(maxsize=512, ttl=3600)
+MALAYSIAN_CACHE = TTLCache(maxsize=512, ttl=3600)
+
+# USDA nutrient names mapped straight to our output keys (one dict lookup per nutrient).
+# Foundation foods often report energy only as Atwater factors and carbs by summation
+NUTRIENT_MAP = {
+    "Protein": "protein",
+    "Carbohydrate, by difference": "carbohydrates",
+    "Carbohydrate, by summation": "carbohydrates",
+    "Total lipid (fat)": "fat",
+    "Energy": "calories",
+    "Energy (Atwater General Factors)": "calories",
+    "Energy (Atwater Specific Factors)": "calories",
+    "Fiber, total dietary": "fiber"
+}
+MALAYSIAN_NUTRIENT_MAP = {
+    name: "carbs" if key == "carbohydrates" else key for name, key in NUTRIENT_MAP.items()
+}
+
+def run_async(coro, timeout=None):
+    """Run a coroutine on the shared event loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, EVENT_LOOP).result(timeout)
+
+@atexit.register
+def close_usda_client():
+    """Close pooled USDA connections when the instance shuts down"""
+    run_async(USDA_CLIENT.aclose(), timeout=5)
+
+async def warm_usda_connection():
+    """Open the pooled USDA connection before the first request needs it"""
+    try:
+        await USDA_CLIENT.head("/")
+    except httpx.HTTPError:
+        pass
+
+# Serving instances (not the deploy-time import) set up DNS, TCP and TLS during
+# init; the import doesn't wait for it
+if os.environ.get('K_SERVICE'):
+    asyncio.run_coroutine_threadsafe(warm_usda_connection(), EVENT_LOOP)
+
+@dataclass(slots=True)
+class FoodResult:
+    """One formatted USDA search result; the orjson provider serializes it natively"""
+    fdcId: int | None
+    description: str | None
+    dataType: str | None
+    nutrients: dict
+    brandOwner: str | None
+    ingredients: str | None
+    servingSize: float | None
+    servingSizeUnit: str | None
+
+def extract_nutrients(food, nutrient_map=NUTRIENT_MAP):
+    """Pick the tracked nutrients out of a USDA food's nutrient list"""
+    # Several names can map to one key, so count keys rather than names
+    tracked = len(set(nutrient_map.values()))
+    nutrients = {}
+    for nutrient in food.get("foodNutrients", []):
+        key = nutrient_map.get(nutrient.get("nutrientName"))
+        # First entry wins, e.g. Energy in KCAL is listed before Energy in kJ
+        if key and key not in nutrients:
+            nutrients[key] = {"value": nutrient.get("value", 0), "unit": nutrient.get("unitName", "")}
+            # Foods can list 100+ nutrients; stop once every tracked one is found
+            if len(nutrients) == tracked:
+                break
+    return nutrients
+
+async def search_food_nutrition(food_name, data_type, page_size):
+    """Search USDA foods and format the nutrition data of each result"""
+    # /foods/search has no field or nutrient filter, so the only way to trim the
+    # payload is to not ask for more foods than we return
+    page_size = min(page_size, MAX_FOOD_RESULTS)
+    cache_key = (food_name.lower().strip(), data_type, page_size)
+    cached = NUTRITION_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    params = {
+        "query": food_name,
+        "dataType": data_type,
+        "pageSize": page_size,
+        "sortBy": "dataType.keyword",
+        "sortOrder": "asc",
+        "api_key": USDA_API_KEY
+    }
+    
+    response = await USDA_CLIENT.get("/foods/search", params=params)
+    response.raise_for_status()
+    
+    api_data = orjson.loads(response.content)
+    
+    # Process and structure the response
+    formatted_results = []
+    
+    for food in api_data.get("foods", [])[:MAX_FOOD_RESULTS]:
+        formatted_results.append(FoodResult(
+            fdcId=food.get("fdcId"),
+            description=food.get("description"),
+            dataType=food.get("dataType"),
+            nutrients=extract_nutrients(food),
+            brandOwner=food.get("brandOwner"),
+            ingredients=food.get("ingredients"),
+            servingSize=food.get("servingSize"),
+            servingSizeUnit=food.get("servingSizeUnit")
+        ))
+    
+    result = (api_data.get("totalHits", 0), formatted_results)
+    NUTRITION_CACHE[cache_key] = result
+    return result
+
+async def search_malaysian_foods(food_name):
+    """Search USDA foods and keep only Asian/Malaysian cuisine matches"""
+    cache_key = food_name.lower().strip()
+    cached = MALAYSIAN_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    # Only ask for terms the filter below keeps; anything else is fetched and dropped
+    search_query = f"{food_name} {' OR '.join(ASIAN_CUISINE_TERMS)}"
+    
+    params = {
+        "query": search_query,
+        "dataType": "Foundation,SR Legacy",
+        "pageSize": 20,
+        "api_key": USDA_API_KEY
+    }
+    
+    response = await USDA_CLIENT.get("/foods/search", params=params)
+    response.raise_for_status()
+    
+    api_data = orjson.loads(response.content)
+    
+    malaysian_foods = []
+    for food in api_data.get("foods", []):
+        desc_tokens = frozenset(WORD_RE.findall(food.get("description", "").lower()))
+        
+        if desc_tokens & ASIAN_TERMS:
+            malaysian_foods.append({
+                "fdcId": food.get("fdcId"),
+                "description": food.get("description"),
+                "nutrients": extract_nutrients(food, MALAYSIAN_NUTRIENT_MAP),
+                "relevance": "asian_cuisine"
+            })
+            # Nothing past the first matches is returned, so don't parse it
+            if len(malaysian_foods) == MAX_FOOD_RESULTS:
+                break
+    
+    MALAYSIAN_CACHE[cache_key] = malaysian_foods
+    return malaysian_foods
+
 @app.route('/search-food-nutrition', methods=['POST'])
-async def search_food_nutrition_endpoint():
+def search_food_nutrition_endpoint():
     """HTTP endpoint wrapper for USDA food nutrition search"""
     try:
         data = request.get_json()
@@ -24,59 +221,13 @@ async def search_food_nutrition_endpoint():
         if not food_name:
             return jsonify({'error': 'food_name is required'}), 400
         
-        # Your existing search_food_nutrition logic here
-        async with httpx.AsyncClient() as client:
-            params = {
-                "query": food_name,
-                "dataType": data_type,
-                "pageSize": page_size,
-                "sortBy": "dataType.keyword",
-                "sortOrder": "asc",
-                "api_key": USDA_API_KEY
-            }
-            
-            response = await client.get(f"{USDA_BASE_URL}/foods/search", params=params)
-            response.raise_for_status()
-            
-            api_data = response.json()
-            
-            # Process and structure the response
-            formatted_results = []
-            
-            for food in api_data.get("foods", []):
-                nutrients = {}
-                for nutrient in food.get("foodNutrients", []):
-                    nutrient_name = nutrient.get("nutrientName", "")
-                    nutrient_value = nutrient.get("value", 0)
-                    nutrient_unit = nutrient.get("unitName", "")
-                    
-                    if "protein" in nutrient_name.lower():
-                        nutrients["protein"] = {"value": nutrient_value, "unit": nutrient_unit}
-                    elif "carbohydrate" in nutrient_name.lower():
-                        nutrients["carbohydrates"] = {"value": nutrient_value, "unit": nutrient_unit}
-                    elif "total lipid" in nutrient_name.lower() or "fat" in nutrient_name.lower():
-                        nutrients["fat"] = {"value": nutrient_value, "unit": nutrient_unit}
-                    elif "energy" in nutrient_name.lower():
-                        nutrients["calories"] = {"value": nutrient_value, "unit": nutrient_unit}
-                    elif "fiber" in nutrient_name.lower():
-                        nutrients["fiber"] = {"value": nutrient_value, "unit": nutrient_unit}
-                
-                formatted_results.append({
-                    "fdcId": food.get("fdcId"),
-                    "description": food.get("description"),
-                    "dataType": food.get("dataType"),
-                    "nutrients": nutrients,
-                    "brandOwner": food.get("brandOwner"),
-                    "ingredients": food.get("ingredients"),
-                    "servingSize": food.get("servingSize"),
-                    "servingSizeUnit": food.get("servingSizeUnit")
-                })
-            
-            return jsonify({
-                "status": "success",
-                "total_results": api_data.get("totalHits", 0),
-                "foods": formatted_results[:10]
-            })
+        total_hits, formatted_results = run_async(search_food_nutrition(food_name, data_type, page_size))
+        
+        return jsonify({
+            "status": "success",
+            "total_results": total_hits,
+            "foods": formatted_results
+        })
             
     except Exception as e:
         return jsonify({
@@ -86,7 +237,7 @@ async def search_food_nutrition_endpoint():
         }), 500
 
 @app.route('/search-malaysian-foods', methods=['POST'])
-async def search_malaysian_foods_endpoint():
+def search_malaysian_foods_endpoint():
     """HTTP endpoint for Malaysian food search"""
     try:
         data = request.get_json()
@@ -95,58 +246,14 @@ async def search_malaysian_foods_endpoint():
         if not food_name:
             return jsonify({'error': 'food_name is required'}), 400
         
-        # Malaysian food search logic here
-        malaysian_terms = ["malaysian", "asian", "southeast", "nasi", "rendang", "satay", "laksa"]
-        search_query = f"{food_name} {' OR '.join(malaysian_terms)}"
+        malaysian_foods = run_async(search_malaysian_foods(food_name))
         
-        async with httpx.AsyncClient() as client:
-            params = {
-                "query": search_query,
-                "dataType": "Foundation,SR Legacy",
-                "pageSize": 20,
-                "api_key": USDA_API_KEY
-            }
-            
-            response = await client.get(f"{USDA_BASE_URL}/foods/search", params=params)
-            response.raise_for_status()
-            
-            api_data = response.json()
-            
-            malaysian_foods = []
-            for food in api_data.get("foods", []):
-                description = food.get("description", "").lower()
-                
-                if any(term in description for term in ["asian", "chinese", "malaysian", "thai", "indonesian"]):
-                    nutrients = {}
-                    for nutrient in food.get("foodNutrients", []):
-                        name = nutrient.get("nutrientName", "").lower()
-                        value = nutrient.get("value", 0)
-                        unit = nutrient.get("unitName", "")
-                        
-                        if "energy" in name:
-                            nutrients["calories"] = {"value": value, "unit": unit}
-                        elif "protein" in name:
-                            nutrients["protein"] = {"value": value, "unit": unit}
-                        elif "carbohydrate" in name:
-                            nutrients["carbs"] = {"value": value, "unit": unit}
-                        elif "total lipid" in name:
-                            nutrients["fat"] = {"value": value, "unit": unit}
-                        elif "fiber" in name:
-                            nutrients["fiber"] = {"value": value, "unit": unit}
-                    
-                    malaysian_foods.append({
-                        "fdcId": food.get("fdcId"),
-                        "description": food.get("description"),
-                        "nutrients": nutrients,
-                        "relevance": "asian_cuisine"
-                    })
-            
-            return jsonify({
-                "status": "success",
-                "query": food_name,
-                "malaysian_foods": malaysian_foods[:10],
-                "note": "Results filtered for Asian/Malaysian cuisine"
-            })
+        return jsonify({
+            "status": "success",
+            "query": food_name,
+            "malaysian_foods": malaysian_foods,
+            "note": "Results filtered for Asian/Malaysian cuisine"
+        })
             
     except Exception as e:
         return jsonify({
@@ -163,6 +270,8 @@ async def search_malaysian_foods_endpoint():
     ),
     memory=options.MemoryOption.GB_1,
     timeout_sec=60,
+    max_instances=10,
+    concurrency=20,
     secrets=["USDA_API_KEY"]
 )
 def nutrition_search(req):
@@ -177,6 +286,8 @@ def nutrition_search(req):
     ),
     memory=options.MemoryOption.GB_1,
     timeout_sec=60,
+    max_instances=10,
+    concurrency=20,
     secrets=["USDA_API_KEY"]
 )
 def malaysian_food_search(req):
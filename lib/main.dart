@@ -206,9 +206,8 @@ class _HomeScreenState extends State<HomeScreen> with TickerProviderStateMixin {
     });
 
     try {
-      // Convert image to base64
+      // Send the raw bytes; the function base64-encodes them for Gemini itself
       final bytes = await _selectedImage!.readAsBytes();
-      final base64Image = base64Encode(bytes);
       
       print('🚀 Starting enhanced USDA food analysis...');
       print('📏 Image size: ${bytes.length} bytes');
@@ -217,12 +216,10 @@ class _HomeScreenState extends State<HomeScreen> with TickerProviderStateMixin {
       final response = await http.post(
         Uri.parse(FIREBASE_FUNCTION_URL),
         headers: {
-          'Content-Type': 'application/json',
+          'Content-Type': 'application/octet-stream',
           'Accept': 'application/json',
         },
-        body: jsonEncode({
-          'image': base64Image,
-        }),
+        body: bytes,
       ).timeout(Duration(seconds: 120)); // Increased timeout for comprehensive search
 
       print('📡 Response status: ${response.statusCode}');